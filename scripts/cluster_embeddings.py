@@ -3,28 +3,61 @@
 Hierarchical clustering of pre-computed embeddings.
 
 Reads a vectors TSV (from embed_csv.py) and the corresponding metadata TSV,
-performs Ward hierarchical clustering, cuts the dendrogram at multiple levels,
-and writes an augmented metadata TSV with one cluster column per level.
+clusters them at multiple levels (k-means, or a Ward dendrogram cut at each
+level), and writes an augmented metadata TSV with one cluster column per level.
 
 Usage:
   python cluster_embeddings.py output/all-minilm-l6-v2/projector_vectors.tsv \\
       --metadata output/all-minilm-l6-v2/projector_metadata.tsv \\
-      --levels 3 5 10 20
+      --levels 3 5 10 20 --method ward
 """
 
 import argparse
+import hashlib
 import sys
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from sklearn.cluster import BisectingKMeans
+from scipy.cluster.hierarchy import fcluster
 from tqdm import tqdm
 
+METHODS = ('kmeans', 'ward', 'hdbscan')
+PRECISIONS = ('f32', 'f16', 'i8')
+L2_CACHE_BYTES = 1 << 20  # conservative per-core L2 size for distance tiling
+
+
+def is_fresh(path: Path, source: Path) -> bool:
+    """True if path exists and is at least as new as the file it was derived from."""
+    return path.exists() and path.stat().st_mtime >= source.stat().st_mtime
+
+
+def tsv_stamp(path: Path) -> np.ndarray:
+    """Size and mtime_ns of a vectors TSV, recorded in its .npz sidecar."""
+    st = path.stat()
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
 
 def load_vectors(path: Path) -> np.ndarray:
-    """Load a tab-separated vectors file (no header) into a numpy array."""
-    return np.loadtxt(path, delimiter='\t', dtype=np.float32)
+    """
+    Load a tab-separated vectors file (no header) into a numpy array.
+
+    Prefers the .npz sidecar written alongside the TSV when the size and
+    mtime_ns it records still match the TSV — a TSV replaced by cp -p or
+    rsync no longer matches. Otherwise parses the TSV with pandas' C engine
+    and rewrites the sidecar for the next stage.
+    """
+    npz_path = path.with_suffix('.npz')
+    if npz_path.exists():
+        with np.load(npz_path) as sidecar:
+            if np.array_equal(sidecar['source'], tsv_stamp(path)):
+                return sidecar['vectors'].astype(np.float32, copy=False)
+    vectors = np.ascontiguousarray(pd.read_csv(
+        path, sep='\t', header=None, dtype=np.float32, engine='c').to_numpy())
+    np.savez(npz_path, vectors=vectors, source=tsv_stamp(path))
+    return vectors
 
 
 def load_metadata(path: Path) -> pd.DataFrame:
@@ -32,22 +65,289 @@ def load_metadata(path: Path) -> pd.DataFrame:
     return pd.read_csv(path, sep='\t', dtype=str).fillna('')
 
 
-def cluster(vectors: np.ndarray, levels: list[int]) -> dict[int, np.ndarray]:
+def quantize(vectors: np.ndarray, precision: str) -> tuple[np.ndarray, float]:
+    """
+    Convert vectors to the requested precision; return (vectors, scale).
+
+    i8 scales by 127 / max|v| rather than assuming unit-norm input, since
+    UMAP-reduced vectors are not normalised. A uniform scale leaves Ward's
+    merge order unchanged; divide distances by it to recover the original units.
     """
-    Run BisectingKMeans once per level.
+    if precision == 'f16':
+        return np.ascontiguousarray(vectors, dtype=np.float16), 1.0
+    if precision == 'i8':
+        scale = 127 / max(float(np.abs(vectors).max()), np.finfo(np.float32).tiny)
+        quantized = np.round(vectors * scale).clip(-128, 127).astype(np.int8)
+        return np.ascontiguousarray(quantized), scale
+    return np.ascontiguousarray(vectors, dtype=np.float32), 1.0
+
 
-    BisectingKMeans recursively bisects the data — O(n log k) time and O(n)
-    memory, making it practical for large corpora where AgglomerativeClustering
-    and scipy Ward both require O(n²) distance matrices.
+def condensed_distances(vectors: np.ndarray) -> np.ndarray:
     """
-    results = {}
-    for n in tqdm(sorted(levels), desc="Clustering levels", unit="level"):
-        model = BisectingKMeans(n_clusters=n, random_state=42)
-        labels = model.fit_predict(vectors) + 1  # make 1-based for consistency
-        results[n] = labels
+    Pairwise Euclidean distances in scipy's condensed (pdist) layout.
+
+    SimSIMD computes squared distances natively in f32, f16 or i8, a tile of
+    rows against all later rows per call. Tiles are sized so each block of
+    results fits in about half of L2, and are square-rooted straight into a
+    preallocated float64 buffer while still hot. float64 is fastcluster's
+    working type, so no conversion is needed, though fastcluster still makes
+    one copy of the buffer. Imports lazily like the other optional backends.
+    """
+    import simsimd
+
+    n = len(vectors)
+    distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    tile = max(1, L2_CACHE_BYTES // 2 // (max(n, 1) * distances.itemsize))
+    start = 0
+    with tqdm(total=max(n - 1, 0), desc="Distances", unit="row", leave=False) as bar:
+        for i0 in range(0, n - 1, tile):
+            i1 = min(i0 + tile, n - 1)
+            block = np.asarray(
+                simsimd.cdist(vectors[i0:i1], vectors[i0 + 1:], metric='sqeuclidean'))
+            # Row i0 + r of the block holds distances to rows i0 + 1 onwards,
+            # so its condensed segment (j > i) starts at column r
+            for r in range(i1 - i0):
+                end = start + n - 1 - (i0 + r)
+                np.sqrt(block[r, r:], out=distances[start:end])
+                start = end
+            bar.update(i1 - i0)
+    return distances
+
+
+def ward_linkage(vectors: np.ndarray, precision: str = 'f32') -> np.ndarray:
+    """
+    Build a Ward linkage matrix from the vectors.
+
+    At f32, fastcluster's linkage_vector runs nearest-neighbour-chain Ward
+    straight from the coordinates, so no pairwise distance matrix is ever
+    materialised — O(n²) time but O(n) memory. At f16/i8 the distances are
+    computed on the quantized vectors with SimSIMD instead, which needs an
+    O(n²) condensed matrix — peaking at twice its size, since fastcluster
+    copies it once. Imports lazily so the kmeans path doesn't need it.
+    """
+    import fastcluster
+
+    if precision == 'f32':
+        return fastcluster.linkage_vector(
+            np.ascontiguousarray(vectors, dtype=np.float64), method='ward')
+
+    quantized, scale = quantize(vectors, precision)
+    distances = condensed_distances(quantized)
+    if scale != 1.0:
+        distances /= scale
+    # distances isn't needed afterwards, so let fastcluster skip its second copy
+    return fastcluster.linkage(distances, method='ward', preserve_input=False)
+
+
+def weighted_ward_linkage(centroids: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Build a Ward linkage matrix over centroids standing for weighted clusters.
+
+    Each merge joins the pair whose union raises the total within-cluster sum
+    of squares least, w_a·w_b/(w_a+w_b)·‖c_a−c_b‖², so the dendrogram is Ward
+    on the partition the centroids summarise rather than on k equal points.
+    Costs are updated with the Lance–Williams recurrence, O(k³) over the
+    centroids. Heights are sqrt(2·cost), matching scipy's Ward for unit weights.
+    """
+    k = len(centroids)
+    c = centroids.astype(np.float64)
+    w = weights.astype(np.float64)
+    sq = (c * c).sum(axis=1)
+    cost = np.maximum(sq[:, None] + sq[None, :] - 2 * c @ c.T, 0)
+    cost *= np.outer(w, w) / (w[:, None] + w[None, :])
+    np.fill_diagonal(cost, np.inf)
+
+    node = np.arange(k)       # dendrogram id of the cluster held in each row
+    size = np.ones(k)         # centroids under each node
+    Z = np.empty((k - 1, 4))
+    for step in range(k - 1):
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        i, j = min(i, j), max(i, j)
+        Z[step] = (min(node[i], node[j]), max(node[i], node[j]),
+                   np.sqrt(2 * cost[i, j]), size[i] + size[j])
+        merged = ((w[i] + w) * cost[i] + (w[j] + w) * cost[j]
+                  - w * cost[i, j]) / (w[i] + w[j] + w)
+        cost[i], cost[:, i] = merged, merged
+        cost[i, i] = np.inf
+        cost[j], cost[:, j] = np.inf, np.inf
+        w[i] += w[j]
+        size[i] += size[j]
+        node[i] = k + step
+    return Z
+
+
+def kmeans(vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Run faiss k-means and return (0-based labels, centroids).
+
+    faiss computes the assignment distances with BLAS/SIMD kernels across all
+    cores, and uses any available GPUs. Imports lazily like the Ward path.
+    """
+    import faiss
+
+    vecs = np.ascontiguousarray(vectors, dtype=np.float32)
+    km = faiss.Kmeans(vecs.shape[1], k, niter=20, seed=42,
+                      gpu=faiss.get_num_gpus() > 0)
+    km.train(vecs)
+    _, labels = km.index.search(vecs, 1)
+    return labels.ravel(), km.centroids
+
+
+def vectors_digest(vectors: np.ndarray) -> str:
+    """Content hash of the vectors, including shape and dtype."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{vectors.shape}{vectors.dtype}".encode())
+    h.update(np.ascontiguousarray(vectors).data)
+    return h.hexdigest()
+
+
+def load_cached_linkage(cache_path: Path, vectors_path: Path,
+                        vectors: np.ndarray) -> np.ndarray | None:
+    """
+    Return the cached Ward linkage if it still belongs to these vectors.
+
+    The cache must be newer than the vectors file and carry the same content
+    hash — mtimes alone survive cp -p, rsync and tar — and Z must have one
+    merge per vector bar one.
+    """
+    if not is_fresh(cache_path, vectors_path):
+        return None
+    with np.load(cache_path) as cache:
+        Z, digest = cache['Z'], str(cache['digest'])
+    if len(Z) != len(vectors) - 1 or digest != vectors_digest(vectors):
+        return None
+    return Z
+
+
+def dendrogram_cutter(Z: np.ndarray,
+                      fine: np.ndarray | None = None) -> Callable[[int], np.ndarray]:
+    """
+    Return a function cutting linkage matrix Z into at most n clusters.
+
+    When Z was built over k-means centroids, fine maps each vector to its
+    centroid so the cut labels vectors rather than centroids.
+    """
+    def cut(n: int) -> np.ndarray:
+        labels = fcluster(Z, t=n, criterion='maxclust')
+        return labels if fine is None else labels[fine]
+
+    return cut
+
+
+def hdbscan_cutter(vectors: np.ndarray, steps: int = 64) -> Callable[[int], np.ndarray]:
+    """
+    Fit HDBSCAN and return a function cutting its tree into ~n clusters.
+
+    HDBSCAN builds an approximate minimum spanning tree with Boruvka over a
+    space tree — roughly O(n log n), for corpora too large for Ward. Cuts are
+    taken at the tree's merge heights, ranked from the root down. A scan of
+    `steps` ranks, spaced geometrically so the coarse levels in the last few
+    merges are covered densely, finds the peak cluster count; below the peak
+    clusters dissolve into noise rather than split. Each level then bisects
+    the ranks above the peak for the cut whose count is closest to n, which
+    is exact wherever the tree has one. Points in components smaller than
+    min_cluster_size are noise, labelled 0. Imports lazily.
+    """
+    from functools import lru_cache
+
+    import hdbscan
+
+    n_vectors = len(vectors)
+    min_cluster_size = min(max(50, n_vectors // 100), max(2, n_vectors // 10))
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size,
+                                core_dist_n_jobs=-1, approx_min_span_tree=True)
+    clusterer.fit(vectors)
+    tree = clusterer.single_linkage_tree_
+
+    heights = np.unique(tree.to_numpy()[:, 2])[::-1]  # root first
+
+    @lru_cache(maxsize=None)
+    def count(rank: int) -> int:
+        return int(tree.get_clusters(heights[rank], min_cluster_size).max()) + 1
+
+    grid = np.unique(np.geomspace(1, len(heights), steps).astype(int)) - 1
+    peak = int(grid[np.argmax([count(int(r)) for r in grid])])
+
+    def cut(n: int) -> np.ndarray:
+        # Highest cut (lowest rank) whose count reaches n; counts rise as the
+        # cut descends towards the peak
+        lo, hi = 0, peak
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if count(mid) >= n:
+                hi = mid
+            else:
+                lo = mid + 1
+        # The cut just above may be closer; on ties prefer it, as it leaves less noise
+        if lo > 0 and abs(count(lo - 1) - n) <= abs(count(lo) - n):
+            lo -= 1
+        return tree.get_clusters(heights[lo], min_cluster_size) + 1
+
+    return cut
+
+
+def cluster(vectors: np.ndarray, levels: list[int], method: str = 'kmeans',
+            precision: str = 'f32',
+            vectors_path: Path | None = None) -> dict[int, np.ndarray]:
+    """
+    Label the vectors at each requested level.
+
+    kmeans: run faiss k-means once at the finest level, then build a Ward
+    dendrogram over its centroids, weighted by cluster size, and cut that for
+    the coarser levels — one O(nk) k-means fit serves every level, and
+    clusters nest across levels. Each merge is the cheapest Ward merge of the
+    k-means clusters, though coarse levels can't split a k-means cluster.
+
+    ward: build one Ward dendrogram and cut it at every level, so clusters
+    nest cleanly from coarse to fine levels. O(n²) time but O(n) memory at
+    f32; f16/i8 trade O(n²) memory for cheaper distance computations.
+
+    hdbscan: fit HDBSCAN once and cut its single-linkage tree near each level
+    — for corpora where Ward's O(n²) time is infeasible. Counts are
+    approximate and noise points get label 0.
+
+    When vectors_path is given, the Ward linkage is cached beside it as
+    <vectors>.ward-<precision>.npz and reused while it is newer than the
+    vectors and matches their content hash, so re-running with different
+    levels only repeats the cuts.
+    """
+    if method == 'hdbscan':
+        print("🌲 Fitting HDBSCAN...")
+        cut = hdbscan_cutter(vectors)
+    elif method == 'ward':
+        cache_path = vectors_path.with_suffix(f'.ward-{precision}.npz') \
+            if vectors_path else None
+        Z = load_cached_linkage(cache_path, vectors_path, vectors) \
+            if cache_path else None
+        if Z is not None:
+            print(f"🌳 Reusing cached Ward dendrogram: {cache_path}")
+        else:
+            print(f"🌳 Building Ward dendrogram ({precision})...")
+            Z = ward_linkage(vectors, precision)
+            if cache_path:
+                np.savez(cache_path, Z=Z, digest=vectors_digest(vectors))
+        cut = dendrogram_cutter(Z)
+    else:
+        k = max(levels)
+        print(f"🎯 Running k-means (k={k})...")
+        fine, centroids = kmeans(vectors, k)
+        weights = np.maximum(np.bincount(fine, minlength=len(centroids)), 1)
+        cut = dendrogram_cutter(weighted_ward_linkage(centroids, weights), fine)
+
+    # Each cut only reads the shared tree, so the levels run concurrently
+    levels = sorted(levels)
+    with ThreadPoolExecutor() as pool:
+        results = dict(zip(levels, pool.map(cut, levels)))
+
+    for n, labels in results.items():
         counts = np.bincount(labels)[1:]
-        tqdm.write(f"   cluster_{n:02d}: {n} clusters "
-                   f"(min={counts.min()} med={int(np.median(counts))} max={counts.max()})")
+        noise = int((labels == 0).sum())
+        if len(counts) == 0:
+            print(f"   cluster_{n:02d}: no clusters (all {noise} points are noise)")
+            continue
+        print(f"   cluster_{n:02d}: {len(counts)} clusters "
+              f"(min={counts.min()} med={int(np.median(counts))} max={counts.max()})"
+              + (f" + {noise} noise" if noise else ""))
     return results
 
 
@@ -75,6 +375,17 @@ Output:
     parser.add_argument('--levels', '-l', nargs='+', type=int,
                         default=[3, 5, 10, 20],
                         help='Number of clusters to cut at (default: 3 5 10 20)')
+    parser.add_argument('--method', choices=METHODS, default='kmeans',
+                        help='Clustering method: kmeans (one faiss k-means fit, '
+                             'centroids merged for coarser levels), '
+                             'ward (Ward dendrogram cut at each level) or '
+                             'hdbscan (approximate, for very large corpora; '
+                             'noise = 0) (default: kmeans)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='f32',
+                        help='Vector precision for Ward distances: f32 (O(n) '
+                             'memory), or f16/i8 quantized SimSIMD distances '
+                             '(O(n²) memory). Only used by --method ward '
+                             '(default: f32)')
     parser.add_argument('--umap-dims', '-u', type=int, default=0,
                         help='Use UMAP-reduced vectors of this dimensionality '
                              'instead of raw vectors. The file '
@@ -120,6 +431,10 @@ Output:
           + (" (UMAP-reduced)" if args.umap_dims > 0 else ""))
     print(f"  Metadata: {metadata_path}")
     print(f"  Levels:   {args.levels}")
+    print(f"  Method:   {args.method}")
+    if args.precision != 'f32':
+        print(f"  Precision: {args.precision}"
+              + (" (ignored — only used by --method ward)" if args.method != 'ward' else ""))
     print()
 
     vectors = load_vectors(cluster_vectors_path)
@@ -131,13 +446,13 @@ Output:
         sys.exit(1)
 
     print()
-    labels = cluster(vectors, args.levels)
+    labels = cluster(vectors, args.levels, args.method, args.precision,
+                     cluster_vectors_path)
 
     # Add a zero-padded cluster column for each level so they sort nicely
     print()
-    for n, lab in sorted(labels.items()):
-        col = f"cluster_{n:02d}"
-        df[col] = lab.astype(str)
+    df = df.assign(**{f"cluster_{n:02d}": lab.astype(str)
+                      for n, lab in sorted(labels.items())})
 
     output_path.parent.mkdir(parents=True, exist_ok=True)
     df.to_csv(output_path, sep='\t', index=False)
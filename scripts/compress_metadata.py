@@ -20,13 +20,28 @@ import argparse
 import sys
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
+def load_metadata(path: Path) -> pd.DataFrame:
+    """Load a tab-separated metadata file (with header)."""
+    return pd.read_csv(path, sep='\t', dtype=str).fillna('')
+
+
 def compress_column(series: pd.Series, top_n: int) -> pd.Series:
-    """Keep the top_n most frequent values; collapse the rest to 'Other'."""
-    top_values = series.value_counts().head(top_n).index
-    return series.where(series.isin(top_values), other='Other')
+    """
+    Keep the top_n most frequent values; collapse the rest to 'Other'.
+
+    Works on integer codes from a single factorize pass: counts come from
+    bincount and the keep-mask is a lookup into a per-value boolean table.
+    """
+    codes, uniques = pd.factorize(series)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    keep = np.zeros(len(uniques) + 1, dtype=bool)  # extra slot for NaN (code -1)
+    # Stable sort so ties go to the value seen first, as value_counts does
+    keep[np.argsort(-counts, kind='stable')[:max(top_n, 0)]] = True
+    return series.where(keep[codes], other='Other')
 
 
 def main():
@@ -73,7 +88,7 @@ Output:
     print(f"  Top N:    {args.top_n}")
     print()
 
-    df = pd.read_csv(metadata_path, sep='\t', dtype=str).fillna('')
+    df = load_metadata(metadata_path)
 
     if args.columns:
         columns = [c.strip() for c in args.columns.split(',')]
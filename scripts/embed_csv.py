@@ -12,12 +12,16 @@ Usage:
 """
 
 import argparse
+import platform
 import sys
 from pathlib import Path
 import pandas as pd
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 
+BACKENDS = ('torch', 'onnx', 'openvino')
+
 
 def load_csv(filepath: str) -> pd.DataFrame:
     """Load CSV file with automatic encoding detection."""
@@ -28,66 +32,165 @@ def load_csv(filepath: str) -> pd.DataFrame:
 
 
 def combine_text_columns(df: pd.DataFrame, columns: list[str]) -> list[str]:
-    """Combine multiple columns into single text strings."""
-    texts = []
-    for _, row in df.iterrows():
-        parts = []
-        for col in columns:
-            val = row.get(col, '')
-            if pd.notna(val) and str(val).strip():
-                parts.append(str(val).strip())
-        texts.append(' '.join(parts))
-    return texts
-
-
-def generate_embeddings(texts: list[str], model_name: str, batch_size: int = 64) -> np.ndarray:
-    """Generate embeddings for text list with progress."""
-    print(f"📖 Loading model: {model_name}")
-    model = SentenceTransformer(
+    """
+    Combine multiple columns into single text strings, skipping blank values.
+
+    Works column by column rather than row by row: each column is stripped
+    once with pandas string ops, then appended to the running result with
+    numpy's elementwise object concatenation — a space is added only where
+    both sides are non-blank.
+    """
+    combined = np.full(len(df), '', dtype=object)
+    for col in columns:
+        part = df[col].fillna('').astype(str).str.strip().to_numpy(dtype=object)
+        sep = np.where((combined != '') & (part != ''), ' ', '').astype(object)
+        combined = combined + sep + part
+    return combined.tolist()
+
+
+def detect_device() -> tuple[str, str]:
+    """
+    Pick the fastest available torch device and a matching dtype.
+
+    GPUs run in half precision to use their tensor cores — bfloat16 where
+    CUDA supports it (fp16 overflows in some models, e.g. EmbeddingGemma),
+    float16 otherwise. CPU stays float32.
+    """
+    if torch.cuda.is_available():
+        return "cuda", "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+    if torch.backends.mps.is_available():
+        return "mps", "float16"
+    return "cpu", "float32"
+
+
+def cpu_flags() -> set[str]:
+    """x86 feature flags from /proc/cpuinfo (empty where unavailable, e.g. macOS)."""
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def quantized_model_file(backend: str) -> str | None:
+    """
+    Path of the INT8 quantized export for this CPU within a model repo.
+
+    The signed qint8 x86 export needs VNNI: without it ONNX Runtime falls back
+    to VPMADDUBSW, which can saturate and degrade the embeddings. AVX2-only
+    CPUs get the unsigned quint8 export instead. Returns None when no export
+    suits this CPU or its flags can't be read.
+    """
+    if backend == 'openvino':
+        return 'openvino/openvino_model_qint8_quantized.xml'
+    if platform.machine().lower() in ('arm64', 'aarch64'):
+        return 'onnx/model_qint8_arm64.onnx'
+    flags = cpu_flags()
+    if 'avx512_vnni' in flags:
+        return 'onnx/model_qint8_avx512_vnni.onnx'
+    if 'avx2' in flags:
+        return 'onnx/model_quint8_avx2.onnx'
+    return None
+
+
+def load_model(model_name: str, backend: str | None = None) -> SentenceTransformer:
+    """
+    Load the model on the fastest available backend.
+
+    With no backend given, GPUs use torch in half precision and CPU-only hosts
+    try ONNX Runtime with the model's INT8 quantized export for their CPU
+    (see quantized_model_file), falling back to torch when there is none, the
+    model doesn't ship it, or the onnx extras aren't installed. A forced onnx/openvino backend falls back
+    to that backend's unquantized export instead.
+    """
+    device, dtype = detect_device()
+    auto = backend is None
+    if auto:
+        backend = 'onnx' if device == 'cpu' else 'torch'
+
+    if backend != 'torch':
+        file_name = quantized_model_file(backend)
+        reason = "no INT8 export suits this CPU"
+        if file_name:
+            print(f"📖 Loading model: {model_name} ({backend}, {file_name})")
+            try:
+                return SentenceTransformer(model_name, device=device, backend=backend,
+                                           trust_remote_code=True,
+                                           model_kwargs={"file_name": file_name})
+            except Exception as e:  # no quantized export, or backend extras missing
+                reason = str(e)
+        if not auto:
+            print(f"   Quantized model unavailable ({reason}) — using unquantized {backend}")
+            return SentenceTransformer(model_name, device=device, backend=backend,
+                                       trust_remote_code=True)
+        print(f"   Quantized model unavailable ({reason}) — falling back to torch")
+
+    print(f"📖 Loading model: {model_name} (torch, {device}, {dtype})")
+    return SentenceTransformer(
         model_name,
+        device=device,
         backend="torch",
         trust_remote_code=True,
-        model_kwargs={"torch_dtype": "float32"},
+        model_kwargs={"torch_dtype": dtype},
     )
-    
-    print(f"🔢 Generating embeddings for {len(texts)} records...")
-    embeddings = []
-    total = len(texts)
-    
-    for i in range(0, total, batch_size):
-        batch = texts[i:i+batch_size]
-        batch_embeddings = model.encode(batch, show_progress_bar=False)
-        embeddings.append(batch_embeddings)
-        
-        done = min(i + batch_size, total)
-        percent = int(done * 100 / total)
-        bar = '█' * (percent // 2) + '░' * (50 - percent // 2)
-        print(f"\r  Progress: [{bar}] {percent}% ({done}/{total})", end='', flush=True)
-    
-    print()  # newline after progress
-    return np.vstack(embeddings)
+
+
+def generate_embeddings(texts: list[str], model_name: str, batch_size: int = 64,
+                        backend: str | None = None) -> np.ndarray:
+    """Generate embeddings for text list with progress."""
+    model = load_model(model_name, backend)
+
+    # Encode each distinct text once and scatter back to every row that uses it
+    codes, unique_texts = pd.factorize(pd.Series(texts, dtype=object))
+    print(f"🔢 Generating embeddings for {len(texts)} records "
+          f"({len(unique_texts)} unique, {len(unique_texts) / max(len(texts), 1):.0%})...")
+    # One encode call lets SBERT sort by length so batches carry less padding;
+    # normalising makes Euclidean distance downstream equivalent to cosine
+    embeddings = model.encode(
+        list(unique_texts),
+        batch_size=batch_size,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+    return embeddings.astype(np.float32, copy=False)[codes]
+
+
+def tsv_stamp(path: Path) -> np.ndarray:
+    """Size and mtime_ns of a vectors TSV, recorded in its .npz sidecar."""
+    st = path.stat()
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
 
 
 def save_vectors(embeddings: np.ndarray, output_path: Path) -> None:
-    """Save embeddings as TSV (no header, tab-separated floats)."""
-    with open(output_path, 'w', encoding='utf-8') as f:
-        for embedding in embeddings:
-            line = '\t'.join(str(val) for val in embedding)
-            f.write(line + '\n')
+    """
+    Save embeddings as TSV (no header, tab-separated floats).
+
+    Also writes a .npz sidecar, stamped with the TSV's size and mtime, that
+    the umap/cluster scripts load in preference to re-parsing the TSV.
+    """
+    np.savetxt(output_path, embeddings, delimiter='\t', fmt='%.6g')
+    np.savez(output_path.with_suffix('.npz'), vectors=embeddings,
+             source=tsv_stamp(output_path))
     print(f"✅ Vectors saved: {output_path}")
 
 
 def save_metadata(df: pd.DataFrame, output_path: Path) -> None:
-    """Save metadata as TSV with headers."""
-    # Escape tabs and newlines in string columns
-    df_clean = df.copy()
-    for col in df_clean.columns:
-        if df_clean[col].dtype == 'object':
-            df_clean[col] = df_clean[col].fillna('').astype(str)
-            df_clean[col] = df_clean[col].str.replace('\t', '\\t', regex=False)
-            df_clean[col] = df_clean[col].str.replace('\n', '\\n', regex=False)
-    
-    df_clean.to_csv(output_path, sep='\t', index=False)
+    """
+    Save metadata as TSV with headers.
+
+    Tabs and newlines in string columns are escaped in place — no copy of
+    the frame — so callers must be done with the raw text before saving.
+    """
+    escapes = str.maketrans({'\t': '\\t', '\n': '\\n'})
+    for col in df.columns:
+        if df[col].dtype == 'object' or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].fillna('').astype(str).str.translate(escapes)
+
+    df.to_csv(output_path, sep='\t', index=False)
     print(f"✅ Metadata saved: {output_path}")
 
 
@@ -130,6 +233,13 @@ Upload both to: https://projector.tensorflow.org/
         default=64,
         help='Batch size for embedding (default: 64)'
     )
+    parser.add_argument(
+        '--backend',
+        choices=BACKENDS,
+        default=None,
+        help='Inference backend (default: torch on GPU, quantized onnx on CPU '
+             'with torch fallback)'
+    )
     
     args = parser.parse_args()
 
@@ -159,6 +269,7 @@ Upload both to: https://projector.tensorflow.org/
     print(f"  Input:    {input_path}")
     print(f"  Columns:  {', '.join(text_columns)}")
     print(f"  Model:    {args.model}")
+    print(f"  Backend:  {args.backend or 'auto'}")
     print()
     
     # Validate columns exist
@@ -177,7 +288,7 @@ Upload both to: https://projector.tensorflow.org/
         print(f"⚠️  Warning: {empty_count} rows have empty text")
     
     # Generate embeddings
-    embeddings = generate_embeddings(texts, args.model, args.batch_size)
+    embeddings = generate_embeddings(texts, args.model, args.batch_size, args.backend)
     print(f"   Dimensions: {embeddings.shape[1]}")
     
     # Ensure output directory exists
@@ -18,42 +18,81 @@ import sys
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
+
+
+def is_fresh(path: Path, source: Path) -> bool:
+    """True if path exists and is at least as new as the file it was derived from."""
+    return path.exists() and path.stat().st_mtime >= source.stat().st_mtime
+
+
+def tsv_stamp(path: Path) -> np.ndarray:
+    """Size and mtime_ns of a vectors TSV, recorded in its .npz sidecar."""
+    st = path.stat()
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
 
 
 def load_vectors(path: Path) -> np.ndarray:
-    """Load a tab-separated vectors file (no header) into a numpy array."""
+    """
+    Load a tab-separated vectors file (no header) into a numpy array.
+
+    Prefers the .npz sidecar written alongside the TSV when the size and
+    mtime_ns it records still match the TSV — a TSV replaced by cp -p or
+    rsync no longer matches. Otherwise parses the TSV with pandas' C engine
+    and rewrites the sidecar for the next stage.
+    """
     print(f"📐 Loading vectors: {path}")
-    vectors = np.loadtxt(path, delimiter='\t', dtype=np.float32)
+    npz_path = path.with_suffix('.npz')
+    vectors = None
+    if npz_path.exists():
+        with np.load(npz_path) as sidecar:
+            if np.array_equal(sidecar['source'], tsv_stamp(path)):
+                vectors = sidecar['vectors'].astype(np.float32, copy=False)
+    if vectors is None:
+        vectors = np.ascontiguousarray(pd.read_csv(
+            path, sep='\t', header=None, dtype=np.float32, engine='c').to_numpy())
+        np.savez(npz_path, vectors=vectors, source=tsv_stamp(path))
     print(f"   Shape: {vectors.shape[0]} × {vectors.shape[1]}")
     return vectors
 
 
 def reduce(vectors: np.ndarray, dims: int, n_neighbors: int, min_dist: float) -> np.ndarray:
-    """Run UMAP reduction. Imports lazily so startup is fast on --help."""
-    import umap
-    from tqdm import tqdm
-
-    print(f"\n🗺️  Running UMAP: {vectors.shape[1]} → {dims} dims")
+    """
+    Run UMAP reduction. Imports lazily so startup is fast on --help.
+
+    Uses RAPIDS cuML's GPU UMAP when it is installed, otherwise umap-learn
+    across all CPU cores. No random_state is set: umap-learn falls back to a
+    single thread when seeded.
+    """
+    try:
+        from cuml import UMAP
+        backend = 'cuML (GPU)'
+        extra = {}
+    except ImportError:
+        from umap import UMAP
+        backend = 'umap-learn (CPU)'
+        extra = {'n_jobs': -1, 'low_memory': True}
+
+    print(f"\n🗺️  Running UMAP: {vectors.shape[1]} → {dims} dims [{backend}]")
     print(f"   n_neighbors={n_neighbors}  min_dist={min_dist}")
     print(f"   (this may take a few minutes for large corpora)\n")
 
-    reducer = umap.UMAP(
+    reducer = UMAP(
         n_components=dims,
         n_neighbors=n_neighbors,
         min_dist=min_dist,
         metric='euclidean',
-        low_memory=True,
         verbose=True,
+        **extra,
     )
-    return reducer.fit_transform(vectors).astype(np.float32)
+    return np.asarray(reducer.fit_transform(vectors), dtype=np.float32)
 
 
 def save_vectors(vectors: np.ndarray, path: Path) -> None:
-    """Save as tab-separated floats with no header."""
+    """Save as tab-separated floats with no header, plus a .npz sidecar."""
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        for row in vectors:
-            f.write('\t'.join(f'{v:.6f}' for v in row) + '\n')
+    np.savetxt(path, vectors, delimiter='\t', fmt='%.6f')
+    np.savez(path.with_suffix('.npz'), vectors=vectors, source=tsv_stamp(path))
     print(f"\n✅ Written: {path}")
 
 
@@ -100,7 +139,7 @@ Examples:
     output_path = Path(args.output) if args.output \
         else vectors_path.parent / f'projector_umap{args.dims}_vectors.tsv'
 
-    if output_path.exists():
+    if is_fresh(output_path, vectors_path):
         print(f"✓ Already exists, skipping: {output_path}")
         print("  Delete the file to force re-computation.")
         sys.exit(0)